@@ -3,16 +3,27 @@ from __future__ import annotations
 
 import argparse
 import datetime as dt
+import hashlib
+import json
 import os
 import re
+import shutil
 import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Optional, Set, Tuple
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
 
-VIEW_LINE_RE = re.compile(r"^\s*%%@view\s*:\s*(.+?)\s*$")
-BEGIN_RE = re.compile(r"^\s*%%@begin\s*:\s*view\s*=\s*([A-Za-z0-9_.-]+)\s*$")
-END_RE = re.compile(r"^\s*%%@end\s*$")
+# View tags: %%@begin:view=NAME / %%@end blocks and %%@view:a,b line tags.
+# One alternation so each line is matched once; m.lastgroup names the tag kind.
+TAG_RE = re.compile(
+    r"^\s*(?:"
+    r"%%@begin\s*:\s*view\s*=\s*(?P<begin>[A-Za-z0-9_.-]+)"
+    r"|%%@end(?P<end>)"
+    r"|%%@view\s*:\s*(?P<view>.+?)"
+    r")\s*$"
+)
 
 # Detect Mermaid "header" line (diagram type line). We treat it as global.
 MERMAID_HEADER_PREFIXES = (
@@ -21,8 +32,15 @@ MERMAID_HEADER_PREFIXES = (
     "timeline", "requirementDiagram", "quadrantChart", "sankey-beta",
     "xychart-beta",
 )
+MERMAID_HEADER_RE = re.compile(
+    r"^(?:" + "|".join(re.escape(p) for p in MERMAID_HEADER_PREFIXES) + r")(?: |$)"
+)
 
-FRONTMATTER_DELIM_RE = re.compile(r"^\s*---\s*$")
+# SVG rendering: one long-lived Node worker, launched with this puppeteer config.
+REPO_ROOT = Path(__file__).resolve().parents[1]
+RENDER_WORKER = REPO_ROOT / "scripts" / "render_worker.mjs"
+PUPPETEER_CONFIG = REPO_ROOT / "scripts" / "puppeteer.config.json"
+PACKAGE_LOCK = REPO_ROOT / "package-lock.json"
 
 
 def git_sha_short() -> str:
@@ -36,17 +54,29 @@ def now_utc_iso() -> str:
     return dt.datetime.now(dt.timezone.utc).replace(microsecond=0).isoformat()
 
 
-def strip_frontmatter(lines: List[str]) -> List[str]:
+def _is_delim(line: str) -> bool:
+    """True for a YAML front-matter delimiter line (``---``, surrounding whitespace allowed)."""
+    return line.strip() == "---"
+
+
+def strip_frontmatter(lines: Iterable[str]) -> Iterator[str]:
     """Remove leading YAML front-matter if present."""
-    if not lines:
-        return lines
-    if not FRONTMATTER_DELIM_RE.match(lines[0]):
-        return lines
-    # find second ---
-    for i in range(1, len(lines)):
-        if FRONTMATTER_DELIM_RE.match(lines[i]):
-            return lines[i + 1 :]
-    return lines  # malformed; leave as-is
+    it = iter(lines)
+    first = next(it, None)
+    if first is None:
+        return
+    if not _is_delim(first):
+        yield first
+        yield from it
+        return
+    # hold front-matter lines until the second ---
+    held = [first]
+    for ln in it:
+        if _is_delim(ln):
+            yield from it
+            return
+        held.append(ln)
+    yield from held  # malformed; leave as-is
 
 
 def is_global_line(line: str) -> bool:
@@ -57,23 +87,21 @@ def is_global_line(line: str) -> bool:
     if s.startswith("%%{") and s.endswith("}%%"):
         return True
     # Any Mermaid diagram header should be global
-    for p in MERMAID_HEADER_PREFIXES:
-        if s.startswith(p + " ") or s == p:
-            return True
+    if MERMAID_HEADER_RE.match(s):
+        return True
     # Styles should be global by default
     if s.startswith("classDef ") or s.startswith("style ") or s.startswith("linkStyle "):
         return True
     return False
 
 
-def parse_master(master_text: str) -> Tuple[List[str], Dict[str, List[str]]]:
+def parse_master(master_lines: Iterable[str]) -> Tuple[List[str], Dict[str, List[str]]]:
     """
-    Parse master .mmd and return:
+    Parse master .mmd lines (e.g. an open file) and return:
       - global_lines: always included
       - view_to_lines: view-specific lines (already includes global lines later)
     """
-    raw_lines = master_text.splitlines()
-    lines = strip_frontmatter(raw_lines)
+    lines = strip_frontmatter(ln.rstrip("\n") for ln in master_lines)
 
     global_lines: List[str] = []
     view_lines: Dict[str, List[str]] = {}
@@ -87,23 +115,25 @@ def parse_master(master_text: str) -> Tuple[List[str], Dict[str, List[str]]]:
             view_lines.setdefault(v, []).append(ln)
 
     for ln in lines:
+        # Cheap substring check first: untagged lines never reach the regex
+        m = TAG_RE.match(ln) if "%%@" in ln else None
+        tag = m.lastgroup if m else None
+
         # Block handling
-        m_begin = BEGIN_RE.match(ln)
-        if m_begin and not in_block:
+        if tag == "begin" and not in_block:
             in_block = True
-            block_view = m_begin.group(1)
+            block_view = m.group("begin")
             # begin marker itself is not emitted
             continue
 
-        if END_RE.match(ln) and in_block:
+        if tag == "end" and in_block:
             in_block = False
             block_view = None
             continue
 
         # Line-level view tag
-        m_view = VIEW_LINE_RE.match(ln)
-        if m_view and not in_block:
-            pending_views = {v.strip() for v in m_view.group(1).split(",") if v.strip()}
+        if tag == "view" and not in_block:
+            pending_views = {v.strip() for v in m.group("view").split(",") if v.strip()}
             continue
 
         # Decide where this line goes
@@ -130,58 +160,122 @@ def determine_views(view_lines: Dict[str, List[str]], explicit_views: Optional[L
 
 
 def build_carved_mermaid(global_lines: List[str], per_view_lines: List[str]) -> str:
-    # Ensure header/global lines come first, then view-specific lines.
-    out: List[str] = []
+    # Header/global lines first (original order), then view-specific lines
+    # (preserving order), joined once with a trailing newline.
+    return "\n".join(global_lines + per_view_lines).rstrip() + "\n"
 
-    # Keep global lines in original order
-    out.extend(global_lines)
-
-    # Add view-specific lines, preserving order
-    out.extend(per_view_lines)
-
-    # Ensure trailing newline
-    text = "\n".join(out).rstrip() + "\n"
-    return text
 
+def make_md_template(source_rel: str, version: str, generated: str) -> str:
+    """
+    Provenance MD header for one master, as a str.format template.
+    Only {view} and {svg_rel} vary per view; the carved Mermaid and closing
+    fence are appended by the caller.
+    """
+    def esc(v: str) -> str:
+        return v.replace("{", "{{").replace("}", "}}")
 
-def make_md_provenance(
-    view: str,
-    source_rel: str,
-    version: str,
-    generated: str,
-    carved_mermaid: str,
-    svg_rel: str,
-) -> str:
     # Title is the view name, as requested.
     md = []
     md.append("---")
-    md.append(f'title: "{view}"')
-    md.append(f'source: "{source_rel}"')
-    md.append(f'version: "{version}"')
-    md.append(f'generated: "{generated}"')
+    md.append('title: "{view}"')
+    md.append(f'source: "{esc(source_rel)}"')
+    md.append(f'version: "{esc(version)}"')
+    md.append(f'generated: "{esc(generated)}"')
     md.append("---")
     md.append("")
-    md.append(f"# {view}")
+    md.append("# {view}")
     md.append("")
-    md.append(f"[View SVG]({svg_rel})")
+    md.append("[View SVG]({svg_rel})")
     md.append("")
     md.append("```mermaid")
-    md.append(carved_mermaid.rstrip("\n"))
-    md.append("```")
     md.append("")
     return "\n".join(md)
 
 
-def render_svg(mmd_path: Path, svg_path: Path) -> None:
-    svg_path.parent.mkdir(parents=True, exist_ok=True)
-    subprocess.check_call([
-        "npx", "-y", "@mermaid-js/mermaid-cli",
-        "-i", str(mmd_path),
-        "-o", str(svg_path),
-        "--puppeteerConfigFile", "scripts/puppeteer.config.json",
-    ])
+def write_files(pending: List[Tuple[Path, bytes]], max_workers: int = 8) -> None:
+    """Write all (path, data) pairs in one batch; the GIL is released during the writes."""
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        list(ex.map(lambda pd: pd[0].write_bytes(pd[1]), pending))
 
 
+def renderer_fingerprint() -> Optional[bytes]:
+    """
+    Hash of everything besides the Mermaid text that affects a rendered SVG,
+    used to key the SVG cache. The whole package-lock.json is included because
+    mermaid and puppeteer float independently of the mermaid-cli version.
+    Returns None if any input is missing, since the key would not be trustworthy.
+    """
+    h = hashlib.sha256()
+    for path in (PACKAGE_LOCK, PUPPETEER_CONFIG, RENDER_WORKER):
+        if not path.is_file():
+            return None
+        # Hash the repo-relative name so keys don't depend on the checkout location
+        h.update(path.relative_to(REPO_ROOT).as_posix().encode() + b"\0")
+        h.update(path.read_bytes())
+        h.update(b"\0")
+    return h.digest()
+
+
+def svg_cache_key(mmd_path: Path, renderer_id: bytes) -> str:
+    return hashlib.sha256(mmd_path.read_bytes() + renderer_id).hexdigest()
+
+
+def store_in_cache(src: Path, cache_path: Path) -> None:
+    """Copy src into the cache atomically, so an interrupted copy never leaves a truncated entry."""
+    fd, tmp = tempfile.mkstemp(dir=cache_path.parent, suffix=".tmp")
+    os.close(fd)
+    try:
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, cache_path)
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True)
+        raise
+
+
+def render_svgs(
+    jobs: List[Tuple[Path, Path]],
+    concurrency: int = 4,
+    cache_dir: Optional[Path] = None,
+) -> None:
+    """
+    Render (mmd_path, svg_path) pairs with one long-lived browser.
+
+    With a cache_dir, SVGs are looked up by sha256 of the Mermaid text plus the
+    renderer fingerprint, and only cache misses are sent to the browser.
+    """
+    to_cache: List[Tuple[Path, Path]] = []
+    renderer_id = renderer_fingerprint() if cache_dir is not None else None
+    if cache_dir is not None and renderer_id is None:
+        print("Renderer inputs missing (package-lock.json, puppeteer config or render worker); SVG cache disabled")
+    elif cache_dir is not None and renderer_id is not None:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        misses: List[Tuple[Path, Path]] = []
+        for mmd_path, svg_path in jobs:
+            cache_path = cache_dir / f"{svg_cache_key(mmd_path, renderer_id)}.svg"
+            if cache_path.exists():
+                svg_path.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copyfile(cache_path, svg_path)
+            else:
+                misses.append((mmd_path, svg_path))
+                to_cache.append((svg_path, cache_path))
+        jobs = misses
+    if not jobs:
+        return
+    for _, svg_path in jobs:
+        svg_path.parent.mkdir(parents=True, exist_ok=True)
+    payload = "".join(json.dumps({"in": str(m), "out": str(s)}) + "\n" for m, s in jobs)
+    subprocess.run(
+        [
+            "node", str(RENDER_WORKER),
+            "--puppeteerConfigFile", str(PUPPETEER_CONFIG),
+            "--concurrency", str(concurrency),
+        ],
+        input=payload,
+        text=True,
+        check=True,
+    )
+    for svg_path, cache_path in to_cache:
+        store_in_cache(svg_path, cache_path)
 
 
 def main() -> int:
@@ -190,6 +284,9 @@ def main() -> int:
     ap.add_argument("--out", default="diagrams", help="Output directory for carved files")
     ap.add_argument("--views", nargs="*", help="Optional explicit list of views to generate (otherwise inferred)")
     ap.add_argument("--no-render", action="store_true", help="Do not render SVGs (still writes .mmd and .md)")
+    ap.add_argument("--render-concurrency", type=int, default=4, help="Number of diagrams rendered in parallel")
+    ap.add_argument("--cache-dir", default=".cache/mermaid", help="Content-addressed SVG cache directory")
+    ap.add_argument("--no-cache", action="store_true", help="Always re-render SVGs, ignoring the cache")
     args = ap.parse_args()
 
     src_dir = Path(args.src)
@@ -201,17 +298,27 @@ def main() -> int:
     version = git_sha_short()
     generated = now_utc_iso()
 
-    masters = sorted(src_dir.glob("*.mmd"))
+    with os.scandir(src_dir) as it:
+        masters = sorted(Path(e.path) for e in it if e.is_file() and e.name.endswith(".mmd"))
     if not masters:
         print(f"No .mmd files found in {src_dir}")
         return 0
 
+    pending_writes: List[Tuple[Path, bytes]] = []
+    render_jobs: List[Tuple[Path, Path]] = []
+    outputs: List[Tuple[Path, Path]] = []
+
     for master in masters:
-        master_text = master.read_text(encoding="utf-8")
-        global_lines, view_to_lines = parse_master(master_text)
+        with master.open(encoding="utf-8") as f:
+            global_lines, view_to_lines = parse_master(f)
         views = determine_views(view_to_lines, args.views)
 
         base = master.stem  # e.g. UserJourneys
+        md_template = make_md_template(
+            source_rel=str(master.as_posix()),
+            version=version,
+            generated=generated,
+        )
 
         # If no views found (no tags), you can still output a single "all" view
         if not views:
@@ -232,27 +339,33 @@ def main() -> int:
 
             out_dir.mkdir(parents=True, exist_ok=True)
 
-            # Write carved Mermaid
-            mmd_path.write_text(carved, encoding="utf-8")
+            # Queue carved Mermaid
+            pending_writes.append((mmd_path, carved.encode("utf-8")))
 
-            # Render SVG (no metadata in the image)
+            # Queue SVG render (no metadata in the image); all views render in one batch below
             if not args.no_render:
-                render_svg(mmd_path, svg_path)
+                render_jobs.append((mmd_path, svg_path))
 
-            # Write provenance MD (links to SVG)
-            source_rel = str(master.as_posix())
+            # Queue provenance MD (links to SVG)
             svg_rel = f"./{svg_name}"
-            md_text = make_md_provenance(
-                view=view,
-                source_rel=source_rel,
-                version=version,
-                generated=generated,
-                carved_mermaid=carved,
-                svg_rel=svg_rel,
-            )
-            md_path.write_text(md_text, encoding="utf-8")
-
-            print(f"Generated: {md_path} and {svg_path if not args.no_render else '(SVG skipped)'}")
+            md_text = md_template.format(view=view, svg_rel=svg_rel) + carved.rstrip("\n") + "\n```\n"
+            pending_writes.append((md_path, md_text.encode("utf-8")))
+            outputs.append((md_path, svg_path))
+
+    # All .mmd/.md files are written before rendering, which reads the .mmd files
+    write_files(pending_writes)
+
+    if render_jobs:
+        print(f"Rendering {len(render_jobs)} SVG(s)...")
+        render_svgs(
+            render_jobs,
+            concurrency=args.render_concurrency,
+            cache_dir=None if args.no_cache else Path(args.cache_dir),
+        )
+
+    # Only report once everything has actually been written and rendered
+    for md_path, svg_path in outputs:
+        print(f"Generated: {md_path} and {svg_path if not args.no_render else '(SVG skipped)'}")
 
     return 0
 
@@ -0,0 +1,74 @@
+#!/usr/bin/env node
+// Render many Mermaid files to SVG with a single browser instance.
+//
+// Reads newline-delimited JSON jobs from stdin, e.g.
+//   {"in": "diagrams/Foo_overview.mmd", "out": "diagrams/Foo_overview.svg"}
+// and renders them with up to --concurrency pages open at once.
+// Exits non-zero if any job failed.
+
+import fs from "node:fs/promises";
+import path from "node:path";
+import readline from "node:readline";
+import puppeteer from "puppeteer";
+import { renderMermaid } from "@mermaid-js/mermaid-cli";
+
+function parseArgs(argv) {
+  const opts = { puppeteerConfigFile: null, concurrency: 4 };
+  for (let i = 0; i < argv.length; i++) {
+    if (argv[i] === "--puppeteerConfigFile") opts.puppeteerConfigFile = argv[++i];
+    else if (argv[i] === "--concurrency") opts.concurrency = Math.max(1, Number(argv[++i]) || 1);
+  }
+  return opts;
+}
+
+// Same defaults mmdc uses, so output matches `npx @mermaid-js/mermaid-cli -i ... -o ...`.
+const RENDER_OPTS = {
+  backgroundColor: "white",
+  mermaidConfig: { theme: "default" },
+  viewport: { width: 800, height: 600, deviceScaleFactor: 1 },
+};
+
+async function readJobs() {
+  const jobs = [];
+  const rl = readline.createInterface({ input: process.stdin, crlfDelay: Infinity });
+  for await (const line of rl) {
+    if (line.trim()) jobs.push(JSON.parse(line));
+  }
+  return jobs;
+}
+
+async function main() {
+  const opts = parseArgs(process.argv.slice(2));
+  const launchConfig = opts.puppeteerConfigFile
+    ? JSON.parse(await fs.readFile(opts.puppeteerConfigFile, "utf-8"))
+    : {};
+
+  const jobs = await readJobs();
+  if (jobs.length === 0) return;
+
+  const browser = await puppeteer.launch({ headless: "shell", ...launchConfig });
+  let failed = 0;
+  try {
+    let next = 0;
+    const runLane = async () => {
+      while (next < jobs.length) {
+        const job = jobs[next++];
+        try {
+          const definition = await fs.readFile(job.in, "utf-8");
+          const { data } = await renderMermaid(browser, definition, "svg", RENDER_OPTS);
+          await fs.mkdir(path.dirname(job.out), { recursive: true });
+          await fs.writeFile(job.out, data);
+        } catch (err) {
+          failed++;
+          console.error(`Failed to render ${job.in}: ${err?.message ?? err}`);
+        }
+      }
+    };
+    await Promise.all(Array.from({ length: Math.min(opts.concurrency, jobs.length) }, runLane));
+  } finally {
+    await browser.close();
+  }
+  if (failed) process.exitCode = 1;
+}
+
+await main();